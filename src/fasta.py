@@ -17,6 +17,36 @@ def parse_stream(f, comment=b'#'):
     if name is not None:
         yield name, b''.join(sequence)
 
+def parse_bytes(buf, comment=b'#'):
+    """
+    Parse fasta records from an in-memory bytes-like buffer (bytes or mmap)
+    by scanning for record delimiters with find() instead of iterating
+    line by line in Python.
+    """
+    names = []
+    sequences = []
+    n = len(buf)
+    i = buf.find(b'>')
+    while 0 <= i < n:
+        j = buf.find(b'\n', i)
+        if j < 0:
+            j = n
+        names.append(bytes(buf[i+1:j]).strip())
+        # records are delimited by '>' at the start of a line
+        k = buf.find(b'\n>', j)
+        if k < 0:
+            k = n
+        block = bytes(buf[j+1:k])
+        if comment and comment in block:
+            lines = [line for line in block.splitlines()
+                     if not line.startswith(comment)]
+            block = b''.join(lines)
+        else:
+            block = block.replace(b'\r', b'').replace(b'\n', b'')
+        sequences.append(block.upper())
+        i = k + 1
+    return names, sequences
+
 def parse(f, comment=b'#'):
     names = []
     sequences = []
@@ -57,19 +57,17 @@ class BiLM(nn.Module):
     def reverse(self, h):
         packed = type(h) is PackedSequence
         if packed:
-            h,batch_sizes = pad_packed_sequence(h, batch_first=True)
-            h_rvs = h.clone().zero_()
-            for i in range(h.size(0)):
-                n = batch_sizes[i]
-                idx = [j for j in range(n-1, -1, -1)]
-                idx = torch.LongTensor(idx).to(h.device)
-                h_rvs[i,:n] = h[i].index_select(0, idx)
+            h,lengths = pad_packed_sequence(h, batch_first=True)
+            # reverse every row in one gather: position j reads n_i-1-j.
+            # padded positions clamp to 0 and are dropped by the repack
+            pos = torch.arange(h.size(1), device=h.device)
+            idx = (lengths.to(h.device).unsqueeze(1) - 1 - pos).clamp(min=0)
+            idx = idx.unsqueeze(2).expand(-1, -1, h.size(2))
+            h_rvs = h.gather(1, idx)
             # repack h_rvs
-            h_rvs = pack_padded_sequence(h_rvs, batch_sizes, batch_first=True)
+            h_rvs = pack_padded_sequence(h_rvs, lengths, batch_first=True)
         else:
-            idx = [i for i in range(h.size(1)-1, -1, -1)]
-            idx = torch.LongTensor(idx).to(h.device)
-            h_rvs = h.index_select(1, idx)
+            h_rvs = torch.flip(h, [1])
         return h_rvs
 
 
@@ -224,8 +222,10 @@ class BiLM(nn.Module):
         # prepend forward logp with zero
         # postpend reverse logp with zero
 
-        b = h_fwd.size(0)
-        zero = h_fwd.data.new(b,1,logp_fwd.size(2)).zero_()
+        # logp_fwd is padded in both branches here; h_fwd is still a
+        # PackedSequence in the packed branch and has no size()
+        b = logp_fwd.size(0)
+        zero = logp_fwd.new_zeros(b, 1, logp_fwd.size(2))
         logp_fwd = torch.cat([zero, logp_fwd], 1)
         logp_rvs = torch.cat([logp_rvs, zero], 1)
 
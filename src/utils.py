@@ -142,6 +142,43 @@ def collate_paired_sequences(args):
     return x0, x1, torch.stack(y, 0)
 
 
+class BucketBatchSampler(torch.utils.data.Sampler):
+    """
+    Group sequences of similar length into minibatches to reduce
+    the amount of computation wasted on padding. Indices are shuffled,
+    split into chunks of batch_size*chunk_factor, sorted by length
+    within each chunk, and then cut into near-square minibatches.
+    """
+    def __init__(self, lengths, batch_size, chunk_factor=100, shuffle=True):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.chunk_size = batch_size*chunk_factor
+        self.shuffle = shuffle
+
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1)//self.batch_size
+
+    def __iter__(self):
+        n = len(self.lengths)
+        if self.shuffle:
+            order = np.random.permutation(n)
+        else:
+            order = np.arange(n)
+
+        batches = []
+        for i in range(0, n, self.chunk_size):
+            chunk = order[i:i+self.chunk_size]
+            # sort longest first within the chunk so minibatches are near-square
+            chunk = chunk[np.argsort(self.lengths[chunk])[::-1]]
+            for j in range(0, len(chunk), self.batch_size):
+                batches.append(chunk[j:j+self.batch_size])
+        if self.shuffle:
+            np.random.shuffle(batches)
+
+        for batch in batches:
+            yield batch.tolist()
+
+
 class MultinomialResample:
     def __init__(self, trans, p):
         self.p = (1-p)*torch.eye(trans.size(0)).to(trans.device) + p*trans
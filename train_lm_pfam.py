@@ -1,19 +1,21 @@
 from __future__ import print_function,division
 
 import sys
+import copy
+import mmap
 import argparse
 import numpy as np
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.autograd import Variable
 import torch.utils.data
-from torch.nn.utils.rnn import pack_padded_sequence
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence, pad_sequence
 
 import src.fasta as fasta
 from src.alphabets import Uniprot21
 import src.models.sequence
+from src.utils import BucketBatchSampler
 
 parser = argparse.ArgumentParser('Train sequence model')
 
@@ -33,6 +35,11 @@ parser.add_argument('--clip', type=float, default=1, help='gradient clipping max
 
 parser.add_argument('-d', '--device', type=int, default=-2, help='device to use, -1: cpu, 0+: gpu (default: gpu if available, else cpu)')
 
+parser.add_argument('--bf16', action='store_true', help='run forward/loss in bfloat16 autocast (requires Ampere or newer GPU)')
+parser.add_argument('--workers', type=int, default=4, help='number of data loading workers (default: 4)')
+parser.add_argument('--compile', action='store_true', help='fuse model kernels with torch.compile (requires PyTorch 2.x)')
+parser.add_argument('--quant-eval', action='store_true', help='run the test pass with dynamic int8 quantized weights (CPU only)')
+
 parser.add_argument('-o', '--output', help='where to write training curve (default: stdout)')
 parser.add_argument('--save-prefix', help='path prefix for saving models (default: no saving)')
 
@@ -41,18 +48,23 @@ pfam_train = 'data/pfam/Pfam-A.train.fasta'
 pfam_test = 'data/pfam/Pfam-A.test.fasta'
 
 
-def preprocess_sequence(s, alphabet):
+class SequenceBuffer(torch.utils.data.Dataset):
     """
-    Convert alphabet sequence to integer sequence.
-    :param s: sequence in byte format
-    :param alphabet: a function to convert alphabet to integers
-    :return: padded converted sequence
+    Ragged set of encoded sequences stored as one contiguous uint8 buffer
+    plus an int64 offsets array. Indexing returns a zero-copy view into
+    the buffer, which is cheaper to slice and to ship to dataloader
+    workers than an object array of small numpy arrays.
     """
-    x = alphabet.encode(s)
-    # pad with start/stop token
-    z = np.zeros(len(x)+2, dtype=x.dtype)
-    z[1:-1] = x + 1
-    return z
+    def __init__(self, flat, offsets):
+        self.flat = flat
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.flat[self.offsets[i]:self.offsets[i+1]]
+
 
 def load_pfam(path, alph):
     """
@@ -63,23 +75,39 @@ def load_pfam(path, alph):
     :param alph: alphabet conversion function
     :return: groups they belong to, sequence info in integer
     """
-    # load path sequences and families
+    # fold the +1 token shift into the alphabet's 256-entry encoding table
+    # so each sequence is mapped in a single vectorized lookup
+    lut = alph.encoding + 1
+
+    # load path sequences and families; memory-map the file so the byte
+    # scanner works off OS pages instead of a full in-memory copy
     with open(path, 'rb') as f:
-        group = []
-        sequences = []
-        for name,sequence in fasta.parse_stream(f):
-            x = preprocess_sequence(sequence.upper(), alph)
-            sequences.append(x)
-            # name eg: b'G1LZL4_AILME/173-208 G1LZL4.1 PF10417.8;1-cysPrx_C;'
-            # get the last entry of the name, 10-char
-            family = name.split(b';')[-2]
-            # family eg: b'1-cysPrx_C', dtype='|S10', 10-char string;
-            group.append(family)
-
-    # convert to np.array for convenience
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            names, seqs = fasta.parse_bytes(mm)
+
+    group = []
+    sequences = []
+    for name,sequence in zip(names, seqs):
+        x = lut[np.frombuffer(sequence, dtype=np.uint8)]
+        # pad with start/stop token
+        z = np.empty(len(x)+2, dtype=x.dtype)
+        z[0] = z[-1] = 0
+        z[1:-1] = x
+        sequences.append(z)
+        # name eg: b'G1LZL4_AILME/173-208 G1LZL4.1 PF10417.8;1-cysPrx_C;'
+        # get the last entry of the name, 10-char
+        family = name.split(b';')[-2]
+        # family eg: b'1-cysPrx_C', dtype='|S10', 10-char string;
+        group.append(family)
+
+    # families become a fixed-width byte-string array; the sequences are
+    # packed into one contiguous buffer with offsets rather than an
+    # object-dtype array, which workers would have to pickle element-wise
     group = np.array(group)
-    sequences = np.array(sequences)
-    return group, sequences
+    offsets = np.zeros(len(sequences)+1, dtype=np.int64)
+    np.cumsum([len(z) for z in sequences], out=offsets[1:])
+    flat = np.concatenate(sequences)
+    return group, SequenceBuffer(flat, offsets)
 
 
 def main():
@@ -106,6 +134,7 @@ def main():
     lr          = args.lr
     l2          = args.l2
     mb          = args.minibatch_size
+    workers     = args.workers
     tied        = not args.untied
     output      = sys.stdout
     if args.output is not None:
@@ -130,32 +159,61 @@ def main():
         torch.cuda.set_device(device)
     if use_cuda:
         model = model.cuda()
+    dev = torch.device('cuda') if use_cuda else torch.device('cpu')
+    if use_cuda:
+        # batch shapes change every step, so autotune re-benchmarking
+        # never amortizes; keep the faster non-deterministic kernels
+        torch.backends.cudnn.benchmark = False
+        torch.backends.cudnn.deterministic = False
+        # allow TF32 for the LSTM gate and projection matmuls
+        torch.set_float32_matmul_precision('high')
+    # bfloat16 has the same exponent range as fp32, so no GradScaler is needed
+    bf16 = args.bf16 and use_cuda
+
+    # dynamic quantization only pays off on CPU
+    quant_eval = args.quant_eval and not use_cuda
+
+    if args.compile and hasattr(torch, 'compile'):
+        # dynamic=True avoids recompiling for every new batch length
+        model = torch.compile(model, mode='reduce-overhead', dynamic=True)
+
+    solver = torch.optim.Adam(model.parameters(), lr=lr, weight_decay=l2)
 
     ## Iterators and optimizer
     def collate(xs):
-        B = len(xs)
-        N = max(len(x) for x in xs)
         lengths = np.array([len(x) for x in xs], dtype=int)
-        
+
         order = np.argsort(lengths)[::-1]
         lengths = lengths[order]
 
-        X = torch.LongTensor(B, N).zero_() + mask_idx
-        for i in range(B):
-            x = xs[order[i]]
-            n = len(x)
-            X[i,:n] = torch.from_numpy(x)
+        # pad in a single C-level copy rather than row by row in Python
+        tensors = [torch.from_numpy(xs[i]) for i in order]
+        X = pad_sequence(tensors, batch_first=True, padding_value=mask_idx).long()
+        if use_cuda and workers == 0:
+            # no pin thread without workers, so page-lock the batch here to
+            # keep the non_blocking H2D copy asynchronous
+            X = X.pin_memory()
         return X, lengths
 
-    train_iterator = torch.utils.data.DataLoader(X_train, batch_size=mb, shuffle=True
-                                                , collate_fn=collate)
+    # pin host memory when using the GPU so copies can overlap compute,
+    # and keep workers alive between epochs to avoid respawn overhead
+    loader_kwargs = {'num_workers': workers, 'pin_memory': use_cuda and workers > 0}
+    if workers > 0:
+        loader_kwargs['persistent_workers'] = True
+        loader_kwargs['prefetch_factor'] = 2
+
+    # batch sequences of similar length together so LSTM time is not
+    # dominated by padding out to the longest sequence in a random batch
+    train_sampler = BucketBatchSampler(np.diff(X_train.offsets), mb)
+    train_iterator = torch.utils.data.DataLoader(X_train, batch_sampler=train_sampler
+                                                , collate_fn=collate, **loader_kwargs)
     test_iterator = torch.utils.data.DataLoader(X_test, batch_size=mb
-                                               , collate_fn=collate)
+                                               , collate_fn=collate, **loader_kwargs)
 
 
     ## Train the model
     print('# training model', file=sys.stderr)
-    digits = int(np.floor(np.log10(num_epochs))) + 1
+    digits = len(str(num_epochs))
     print('epoch\tsplit\tlog_p\tperplexity\taccuracy', file=output)
     output.flush()
 
@@ -163,21 +221,33 @@ def main():
         # train epoch
         model.train()
         iter = 0
-        n  = 0
+        # accumulate metrics on the device; sync to the host only when printing.
+        # counts are integer sums so they stay exact past 2**24 tokens
+        n           = torch.zeros((), dtype=torch.long, device=dev)
+        loss_sum    = torch.zeros((), dtype=torch.float64, device=dev)
+        correct_sum = torch.zeros((), dtype=torch.long, device=dev)
         accuracy   = 0
         loss_accum = 0
         for X,lengths in train_iterator:
             if use_cuda:
-                X = X.cuda()
-            X     = Variable(X)
-
-            # forward pass
-            logp  = model(X)
-
-            mask  = (X != mask_idx)
-            index = X * mask.long()
-            loss  = -logp.gather(2, index.unsqueeze(2)).squeeze(2)
-            loss  = torch.mean(loss.masked_select(mask))
+                X = X.cuda(non_blocking=True)
+
+            # forward pass, optionally in bfloat16; the optimizer step stays
+            # in fp32 so gradients accumulate against full-precision weights
+            with torch.autocast('cuda', dtype=torch.bfloat16, enabled=bf16):
+                # pack so cuDNN skips the padded timesteps; collate already
+                # sorts each batch longest first. note this also changes the
+                # reverse direction: the padded path flipped the whole padded
+                # axis, so the reverse LSTM consumed the pad run before the
+                # real tokens, while packing reverses only the real tokens.
+                # train/test curves therefore shift slightly vs older runs.
+                packed = pack_padded_sequence(X, lengths, batch_first=True)
+                logp   = model(packed)
+                logp,_ = pad_packed_sequence(logp, batch_first=True)
+
+                # one fused kernel for the gather, mask, and mean over real tokens
+                loss  = F.nll_loss(logp.reshape(-1, logp.size(-1)), X.reshape(-1)
+                                  , ignore_index=mask_idx)
 
             loss.backward()
 
@@ -186,20 +256,18 @@ def main():
             solver.step()
             solver.zero_grad()
 
-            _,y_hat = torch.max(logp, 2)
-            correct = torch.sum((y_hat == X).masked_select(mask))
-            #correct = torch.sum((y_hat == X)[mask.nonzero()].float())
+            mask = (X != mask_idx)
+            b    = mask.sum()
 
-            b = mask.long().sum().item()
-            n += b
-            delta = b*(loss.item() - loss_accum)
-            loss_accum += delta/n
-            delta = correct.item() - b*accuracy
-            accuracy += delta/n
+            loss_sum    += loss.detach()*b
+            correct_sum += torch.sum((logp.argmax(-1) == X) & mask)
+            n           += b
 
             batch = X.size(0)
             iter += batch
             if (iter - batch)//100 < iter//100:
+                loss_accum = (loss_sum/n).item()
+                accuracy = (correct_sum/n).item()
                 print('# [{}/{}] training {:.1%} loss={:.5f}, acc={:.5f}'.format(epoch+1
                                                                 , num_epochs
                                                                 , iter/len(X_train)
@@ -207,46 +275,53 @@ def main():
                                                                 , accuracy
                                                                 )
                      , end='\r', file=sys.stderr)
+        loss_accum = (loss_sum/n).item()
+        accuracy = (correct_sum/n).item()
         print(' '*80, end='\r', file=sys.stderr)
 
         perplex = np.exp(loss_accum)
-        string = str(epoch+1).zfill(digits) + '\t' + 'train' + '\t' + str(loss_accum) \
-                 + '\t' + str(perplex) + '\t' + str(accuracy)
+        string = f'{epoch+1:0{digits}d}\ttrain\t{loss_accum}\t{perplex}\t{accuracy}'
         print(string, file=output)
         output.flush()
 
         # test epoch
         model.eval()
+        eval_model = model
+        if quant_eval:
+            # quantize the Linear/LSTM weights to int8 for this pass only;
+            # the fp32 weights are untouched for the next training epoch
+            eval_model = torch.ao.quantization.quantize_dynamic(
+                            model, {nn.Linear, nn.LSTM}, dtype=torch.qint8)
         it = 0
-        n = 0
+        n           = torch.zeros((), dtype=torch.long, device=dev)
+        loss_sum    = torch.zeros((), dtype=torch.float64, device=dev)
+        correct_sum = torch.zeros((), dtype=torch.long, device=dev)
         accuracy = 0
         loss_accum = 0
-        with torch.no_grad():
+        with torch.inference_mode():
             for X,lengths in test_iterator:
                 if use_cuda:
-                    X = X.cuda()
-                X = Variable(X)
-                logp = model(X)
+                    X = X.cuda(non_blocking=True)
+                with torch.autocast('cuda', dtype=torch.bfloat16, enabled=bf16):
+                    packed = pack_padded_sequence(X, lengths, batch_first=True)
+                    logp   = eval_model(packed)
+                    logp,_ = pad_packed_sequence(logp, batch_first=True)
 
-                mask = (X != mask_idx)
-
-                index = X*mask.long()
-                loss = -logp.gather(2, index.unsqueeze(2)).squeeze(2)
-                loss = torch.mean(loss.masked_select(mask))
+                    loss = F.nll_loss(logp.reshape(-1, logp.size(-1)), X.reshape(-1)
+                                     , ignore_index=mask_idx)
 
-                _,y_hat = torch.max(logp, 2)
-                correct = torch.sum((y_hat == X).masked_select(mask))
+                mask = (X != mask_idx)
+                b    = mask.sum()
 
-                b = mask.long().sum().item()
-                n += b
-                delta = b*(loss.item() - loss_accum)
-                loss_accum += delta/n
-                delta = correct.item() - b*accuracy
-                accuracy += delta/n
+                loss_sum    += loss*b
+                correct_sum += torch.sum((logp.argmax(-1) == X) & mask)
+                n           += b
 
                 b = X.size(0)
                 it += b
                 if (it - b)//100 < it//100:
+                    loss_accum = (loss_sum/n).item()
+                    accuracy = (correct_sum/n).item()
                     print('# [{}/{}] test {:.1%} loss={:.5f}, acc={:.5f}'.format(epoch+1
                                                                     , num_epochs
                                                                     , it/len(X_test)
@@ -254,21 +329,23 @@ def main():
                                                                     , accuracy
                                                                     )
                          , end='\r', file=sys.stderr)
+        loss_accum = (loss_sum/n).item()
+        accuracy = (correct_sum/n).item()
         print(' '*80, end='\r', file=sys.stderr)
 
         perplex = np.exp(loss_accum)
-        string = str(epoch+1).zfill(digits) + '\t' + 'test' + '\t' + str(loss_accum) \
-                 + '\t' + str(perplex) + '\t' + str(accuracy)
+        string = f'{epoch+1:0{digits}d}\ttest\t{loss_accum}\t{perplex}\t{accuracy}'
         print(string, file=output)
         output.flush()
 
         ## save the model
         if save_prefix is not None:
-            save_path = save_prefix + '_epoch' + str(epoch+1).zfill(digits) + '.sav'
-            model = model.cpu()
-            torch.save(model, save_path)
-            if use_cuda:
-                model = model.cuda()
+            save_path = f'{save_prefix}_epoch{epoch+1:0{digits}d}.sav'
+            # save a host-side copy of the underlying module (not the
+            # torch.compile wrapper); the live model and its optimizer
+            # state never leave the GPU
+            module = getattr(model, '_orig_mod', model)
+            torch.save(copy.deepcopy(module).cpu(), save_path)
 
 
 